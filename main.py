@@ -1,11 +1,22 @@
 import aiofiles, aiohttp, asyncio
-import argparse, orjson, os, time
+import argparse, contextlib, orjson, os, time
 
+from aiofiles.threadpool.binary import AsyncFileIO
 from websockets.asyncio.client import connect, ClientConnection
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosed, WebSocketException
+from websockets.protocol import State
 
 from pathlib import Path
-from typing import Any
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 def info(string: str):
@@ -16,66 +27,449 @@ def warn(string: str):
     print("[!] " + string)
 
 
+class Uring:
+    def __init__(self, entries: int = 8):
+        self._ring = liburing.Ring()
+        self._cqe = liburing.Cqe()
+        self._pending: dict[int, asyncio.Future[int]] = {}
+        self._user_data = 0
+
+        liburing.io_uring_queue_init(entries, self._ring)
+
+        # completions are signalled through an eventfd so the event loop can
+        # wait on them like any other readable descriptor
+        self._eventfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        liburing.io_uring_register_eventfd(self._ring, self._eventfd)
+
+        # the log file lives in slot 0 of the registered file table so every
+        # sqe can skip the per-op fd lookup
+        liburing.io_uring_register_files_sparse(self._ring, 1)
+        self._files: "liburing.FileIndex | None" = None
+
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._eventfd, self._reap)
+
+    def register(self, fd: int) -> None:
+        self._files = liburing.FileIndex([fd])
+        liburing.io_uring_register_files_update(self._ring, self._files, 0)
+
+    async def write(self, data: bytes) -> int:
+        sqe = liburing.io_uring_get_sqe(self._ring)
+        liburing.io_uring_prep_write(sqe, 0, data)
+        liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+
+        return await self._submit(sqe)
+
+    async def fsync(self) -> None:
+        sqe = liburing.io_uring_get_sqe(self._ring)
+        liburing.io_uring_prep_fsync(sqe, 0, liburing.IORING_FSYNC_DATASYNC)
+        liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+
+        await self._submit(sqe)
+
+    def close(self) -> None:
+        self._loop.remove_reader(self._eventfd)
+        liburing.io_uring_queue_exit(self._ring)
+        os.close(self._eventfd)
+
+    async def _submit(self, sqe: "liburing.SQE") -> int:
+        self._user_data += 1
+        liburing.io_uring_sqe_set_data64(sqe, self._user_data)
+
+        future = self._loop.create_future()
+        self._pending[self._user_data] = future
+
+        liburing.io_uring_submit(self._ring)
+        return await future
+
+    def _reap(self) -> None:
+        os.eventfd_read(self._eventfd)
+
+        while True:
+            try:
+                liburing.io_uring_peek_cqe(self._ring, self._cqe)
+            except BlockingIOError:
+                break
+
+            cqe = self._cqe[0]
+            user_data, result = cqe.user_data, cqe.res
+            liburing.io_uring_cqe_seen(self._ring, cqe)
+
+            # the caller may have been cancelled while the sqe was in flight
+            future = self._pending.pop(user_data)
+            if future.done():
+                continue
+
+            if result < 0:
+                future.set_exception(OSError(-result, os.strerror(-result)))
+            else:
+                future.set_result(result)
+
+
 class Ingest:
-    def __init__(self, name: str, directory: Path | None, until_flush: int = 1000):
-        self._set: list[dict[str, Any]] = []
+    def __init__(
+        self,
+        name: str,
+        directory: Path | None,
+        until_flush: int = 1000,
+        uring: bool = False,
+        sync_every: int = 0,
+    ):
+        self._buffer = bytearray()
         self._number_of_logs = 0
+        self._number_of_unsynced = 0
+        self._number_of_dropped = 0
 
         self._name = name
         self._until_flush = until_flush
-
-        filename = Path(f"{name}.jsonl")
+        self._max_logs = 10 * until_flush
+        self._sync_every = sync_every
+        self._uring = Uring() if uring else None
+        self._fd: int | None = None
+        self._file: AsyncFileIO | None = None
+        self._lock = asyncio.Lock()
+
+        # batches are written by a task of their own, so a slow disk never
+        # holds up the receive loop that appends to the buffer
+        self._closing = asyncio.Event()
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._write())
+        self._writer.add_done_callback(self._on_writer_done)
+
+        self._filepath = Path(f"{name}.jsonl")
         if directory:
-            self._directory = directory
-            self._directory.mkdir(exist_ok=True)
-            self._filepath = self._directory / filename
-        else:
-            self._filepath = filename
+            directory.mkdir(exist_ok=True)
+            self._filepath = directory / self._filepath
 
     @property
     def name(self) -> str:
         return self._name
 
-    @name.setter
-    def name(self, name: str) -> None:
-        self._name = name
+    def start_window(self, slug: str) -> None:
+        # every window of a coin shares one file, so each starts with a header
+        # line naming the market the frames that follow belong to
+        header = {"_slug": slug}
+        self._buffer += orjson.dumps(header, option=orjson.OPT_APPEND_NEWLINE)
+
+    def append(self, data: bytes) -> None:
+        # frames are dropped rather than buffered without bound while the
+        # writer cannot keep up, or has failed
+        if self._number_of_logs >= self._max_logs:
+            if not self._number_of_dropped:
+                warn(f"{self._name} buffer is full, dropping frames")
+            self._number_of_dropped += 1
+            return
 
-        filename = Path(f"{name}.jsonl")
-        self._filepath = self._directory / filename if self._directory else filename
+        self._buffer += data
+        self._buffer += b"\n"
+        self._number_of_logs += 1
 
-        self.clear()
+        if self._number_of_logs >= self._until_flush:
+            self._ready.set()
 
-    def clear(self) -> None:
-        self._set.clear()
-        self._number_of_logs = 0
+    async def flush(self) -> None:
+        # the writer and the daemon may both flush, and frames keep being
+        # appended while a write is in flight, so writes are serialized and
+        # each detaches the batch it writes once it holds the lock
+        async with self._lock:
+            if not self._buffer:
+                return
+
+            buffer, self._buffer = self._buffer, bytearray()
+            number_of_logs, self._number_of_logs = self._number_of_logs, 0
+
+            written, writing = 0, False
+            try:
+                await self._open()
+
+                while written < len(buffer):
+                    writing = True
+                    written += await self._write_some(buffer[written:])
+                    writing = False
+            except BaseException as e:
+                # whatever of the batch did not reach the file goes back in
+                # front of the frames that arrived meanwhile, so the next flush
+                # retries it in order; a write cancelled in flight is not put
+                # back, since the thread or the sqe behind it still completes
+                if not (writing and isinstance(e, asyncio.CancelledError)):
+                    self._buffer[:0] = buffer[written:]
+                    self._number_of_logs += number_of_logs
+                raise
+
+            if self._number_of_dropped:
+                warn(f"dropped {self._number_of_dropped} {self._name} frames")
+                self._number_of_dropped = 0
+
+            self._number_of_unsynced += 1
+            if self._sync_every and self._number_of_unsynced >= self._sync_every:
+                await self._sync()
 
-    async def append(self, data: dict[str, Any]) -> None:
-        self._set.append(data)
-        self._number_of_logs += 1
+    async def close(self) -> None:
+        self._closing.set()
+        self._ready.set()
+
+        try:
+            # a writer that died has already been reported, and the final
+            # flush retries whatever it left behind
+            await asyncio.wait({self._writer})
+            await self.flush()
+
+            async with self._lock:
+                if self._sync_every and self._number_of_unsynced:
+                    await self._sync()
+        finally:
+            await self._close_file()
+            if self._uring:
+                self._uring.close()
+
+    async def _write(self) -> None:
+        delay = 0.1
+        while not self._closing.is_set():
+            await self._ready.wait()
+            self._ready.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                # the batch has been put back, so it is retried after a backoff
+                # that close() cuts short
+                warn(f"flush of {self._name} failed, retrying: {e}")
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self._closing.wait(), delay)
+
+                delay = min(2 * delay, 60)
+                self._ready.set()
+            else:
+                delay = 0.1
+
+    def _on_writer_done(self, writer: asyncio.Task[None]) -> None:
+        if not writer.cancelled() and (e := writer.exception()):
+            warn(f"writer for {self._name} failed: {e!r}")
+
+    async def _open(self) -> None:
+        if self._uring:
+            if self._fd is None:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+                self._fd = os.open(self._filepath, flags, 0o644)
+                self._uring.register(self._fd)
+        elif self._file is None:
+            # the file is unbuffered, so what write returns is exactly what
+            # reached it and nothing is left behind to be written twice
+            self._file = await aiofiles.open(self._filepath, mode="ab", buffering=0)
+
+    async def _write_some(self, data: bytearray) -> int:
+        if self._uring:
+            return await self._uring.write(data)
+        return await self._file.write(data)
+
+    async def _sync(self) -> None:
+        if self._uring:
+            await self._uring.fsync()
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, os.fdatasync, self._file.fileno())
+
+        self._number_of_unsynced = 0
 
-        if self._number_of_logs < self._until_flush:
+    async def _close_file(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        if self._file is not None:
+            await self._file.close()
+            self._file = None
+
+
+class Multiplexer:
+    _PM_CLOB_ENDPOINT = "wss://ws-subscriptions-clob.polymarket.com/ws/market"
+
+    def __init__(self):
+        self._socket: ClientConnection | None = None
+        self._standby: asyncio.Task[ClientConnection] | None = None
+        self._receiver: asyncio.Task[None] | None = None
+        self._lock = asyncio.Lock()
+
+        # token ids are quoted the way they appear in a frame, and the encoded
+        # subscribe and unsubscribe payloads of every market are kept, the
+        # former to be resent on reconnect
+        self._routes: dict[bytes, Ingest] = {}
+        self._payloads: dict[tuple[str, str], tuple[bytes, bytes]] = {}
+
+    async def subscribe(self, tokens: tuple[str, str], ingest: Ingest) -> None:
+        async with self._lock:
+            if not self._socket:
+                self._socket = await Multiplexer._connect()
+                self._warm_standby()
+                self._receiver = asyncio.create_task(self._receive())
+
+        for token in tokens:
+            self._routes[f'"{token}"'.encode()] = ingest
+
+        subscribe = orjson.dumps({"assets_ids": tokens, "operation": "subscribe"})
+        unsubscribe = orjson.dumps({"assets_ids": tokens, "operation": "unsubscribe"})
+        self._payloads[tokens] = subscribe, unsubscribe
+
+        await self._send(subscribe)
+
+    async def unsubscribe(self, tokens: tuple[str, str]) -> None:
+        for token in tokens:
+            self._routes.pop(f'"{token}"'.encode(), None)
+
+        if payloads := self._payloads.pop(tokens, None):
+            await self._send(payloads[1])
+
+    async def sleep(self, delay: float) -> None:
+        if not self._receiver:
+            await asyncio.sleep(delay)
             return
 
-        await self.flush()
+        # a receiver that died would leave every daemon sleeping on a socket
+        # nobody reads, so its failure is raised in their place
+        sleep = asyncio.create_task(asyncio.sleep(delay))
+        try:
+            await asyncio.wait(
+                {sleep, self._receiver}, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            sleep.cancel()
 
-    async def flush(self) -> None:
-        async with aiofiles.open(self._filepath, mode="ab") as file:
-            for data in map(orjson.dumps, self._set):
-                await file.write(data)
-                await file.write(os.linesep.encode())
+        if self._receiver.done():
+            self._receiver.result()
+            raise ConnectionError("the receiver stopped")
+
+    async def close(self) -> None:
+        if self._receiver:
+            # whatever the receiver failed with has already reached the daemons
+            self._receiver.cancel()
+            await asyncio.wait({self._receiver})
+
+        if self._socket:
+            await self._socket.close()
+        if standby := await self._take_standby():
+            await standby.close()
+
+    async def _receive(self) -> None:
+        resubscription: asyncio.Task[None] | None = None
+
+        # frames still in flight for a market just unsubscribed from, or that
+        # carry no asset id, are counted and reported once the next one routes
+        number_of_unrouted = 0
+
+        while True:
+            try:
+                message = await self._socket.recv(decode=False)
+            except ConnectionClosed as e:
+                warn(f"connection closed, reconnecting: {e}")
+                await self._reconnect()
+
+                # the cached payloads go out while the loop is already waiting
+                # on the new socket, rather than before it starts to; one still
+                # pending was meant for the socket that just closed
+                if resubscription:
+                    resubscription.cancel()
+                resubscription = asyncio.create_task(self._resubscribe())
+                continue
+
+            if resubscription:
+                await resubscription
+                resubscription = None
+
+            if ingest := self._route(message):
+                if number_of_unrouted:
+                    warn(f"dropped {number_of_unrouted} frames matching no market")
+                    number_of_unrouted = 0
+
+                ingest.append(message)
+            else:
+                number_of_unrouted += 1
+
+    def _route(self, message: bytes) -> Ingest | None:
+        # asset ids sit at different depths depending on the event type (and
+        # book snapshots arrive as a list), but they are 70+ digit strings, so
+        # looking for the quoted id is exact and spares parsing the frame
+        for token, ingest in self._routes.items():
+            if token in message:
+                return ingest
+        return None
+
+    async def _resubscribe(self) -> None:
+        for subscribe, _ in list(self._payloads.values()):
+            await self._send(subscribe)
+
+    async def _send(self, payload: bytes) -> None:
+        if not self._socket:
+            warn("unable to send since there is no socket")
+            return
+
+        try:
+            await self._socket.send(payload)
+        except ConnectionClosed:
+            # the receiver reconnects and resends every subscription
+            pass
+
+    async def _reconnect(self) -> None:
+        socket = await self._take_standby()
+
+        delay = 1
+        while not socket:
+            try:
+                socket = await Multiplexer._connect()
+            except (OSError, TimeoutError, WebSocketException) as e:
+                warn(f"reconnect failed, retrying in {delay} seconds: {e}")
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, 60)
+
+        socket, self._socket = self._socket, socket
+        self._warm_standby()
+
+        if socket:
+            await socket.close()
+
+    def _warm_standby(self) -> None:
+        # a second connection is kept open, but not subscribed, so that a
+        # reconnect does not have to wait for a fresh tcp + tls handshake
+        self._standby = asyncio.create_task(Multiplexer._connect())
 
-        self.clear()
+    async def _take_standby(self) -> ClientConnection | None:
+        standby, self._standby = self._standby, None
+        if not standby:
+            return None
+
+        try:
+            socket = await standby
+        except (OSError, TimeoutError, WebSocketException) as e:
+            warn(f"standby connection failed: {e}")
+            return None
+
+        return socket if socket.state is State.OPEN else None
+
+    @staticmethod
+    async def _connect() -> ClientConnection:
+        # frames are read with decode=False, so text frames are never run
+        # through the utf-8 decoder; lift the 1 MiB cap for book snapshots and
+        # let more frames queue up before reading from the socket is paused
+        return await connect(
+            Multiplexer._PM_CLOB_ENDPOINT, max_size=None, max_queue=1024
+        )
 
 
 class Daemon:
     _PM_GAMMA_ENDPOINT = "https://gamma-api.polymarket.com/markets/slug/"
-    _PM_CLOB_ENDPOINT = "wss://ws-subscriptions-clob.polymarket.com/ws/market"
 
-    def __init__(self, coin: str, directory: Path | None = None):
+    def __init__(
+        self,
+        coin: str,
+        session: aiohttp.ClientSession,
+        multiplexer: Multiplexer,
+        directory: Path | None = None,
+        uring: bool = False,
+        sync_every: int = 0,
+    ):
         self._coin = coin
-        self._socket: ClientConnection | None = None
-        self._session = aiohttp.ClientSession(Daemon._PM_GAMMA_ENDPOINT)
-        self._ingest = Ingest(coin, directory)
+        self._session = session
+        self._multiplexer = multiplexer
+        self._ingest = Ingest(coin, directory, uring=uring, sync_every=sync_every)
 
     @property
     def coin(self) -> str:
@@ -85,75 +479,46 @@ class Daemon:
         base = Daemon._get_timestamp()
         timestamps = [base + 900 * i for i in range(1, windows + 1)]
 
-        till_next = timestamps[0] - time.time_ns() // 10**9
-        info(f"sleeping for {till_next} seconds till next {self.coin} window")
-        await asyncio.sleep(till_next)
+        # the wall clock is mapped onto the loop's monotonic clock once, and
+        # every window's start and end is precomputed on the latter
+        loop = asyncio.get_running_loop()
+        offset = loop.time() - time.time()
+        deadlines = [offset + timestamp + 900 for timestamp in timestamps]
 
-        self._socket = await connect(Daemon._PM_CLOB_ENDPOINT)
+        till_next = offset + timestamps[0] - loop.time()
+        info(f"sleeping for {till_next:.0f} seconds till next {self.coin} window")
+        await asyncio.sleep(till_next)
 
-        for i in range(windows):
-            slug = f"{self._coin}-updown-15m-{timestamps[i]}"
+        for timestamp, deadline in zip(timestamps, deadlines):
+            slug = f"{self._coin}-updown-15m-{timestamp}"
             tokens = await self._get_tokens(slug)
-            self._ingest.name = slug
-
-            await self._subscribe(tokens)
-
-            run_for = timestamps[i] + 900 - time.time_ns() // 10**9
-            deadline = asyncio.get_running_loop().time() + run_for
-
-            info(f"will monitor {slug} for {run_for} seconds")
-
-            while True:
-                try:
-                    async with asyncio.timeout_at(deadline):
-                        message = await self._socket.recv()
-                        data = orjson.loads(message)
-                        await self._ingest.append(data)
-                except TimeoutError:
-                    info(f"timeout for {slug}, moving onto the next window")
-                    await self._ingest.flush()
-                    await self._reconnect()
-                    break
-                except ConnectionClosedError as e:
-                    warn(f"connection closed for {self._coin}, reconnecting: {e}")
-                    await self._reconnect()
-                    await self._subscribe(tokens)
-
-            pass
+            self._ingest.start_window(slug)
 
-    async def close(self) -> None:
-        if self._socket:
-            await self._socket.close()
-        await self._session.close()
+            await self._multiplexer.subscribe(tokens, self._ingest)
 
-    async def _reconnect(self) -> None:
-        if self._socket:
-            await self._socket.close()
-        self._socket = await connect(Daemon._PM_CLOB_ENDPOINT)
+            run_for = deadline - loop.time()
 
-    async def _subscribe(self, tokens: tuple[str, str]) -> None:
-        await self._scribe(tokens, "subscribe")
+            info(f"will monitor {slug} for {run_for:.0f} seconds")
 
-    async def _unsubscribe(self, tokens: tuple[str, str]) -> None:
-        await self._scribe(tokens, "unsubscribe")
+            await self._multiplexer.sleep(run_for)
 
-    async def _scribe(self, tokens: tuple[str, str], operation: str) -> None:
-        if not self._socket:
-            warn(f"unable to {operation} sinec there is no socket")
-            return
+            info(f"timeout for {slug}, moving onto the next window")
+            await self._multiplexer.unsubscribe(tokens)
+            await self._ingest.flush()
 
-        await self._socket.send(
-            orjson.dumps({"assets_ids": tokens, "operation": operation})
-        )
+    async def close(self) -> None:
+        await self._ingest.close()
 
     async def _get_tokens(self, slug: str) -> tuple[str, str]:
         async with self._session.request("GET", slug) as response:
-            return orjson.loads((await response.json())["clobTokenIds"])
+            market = orjson.loads(await response.read())
+
+        # gamma serves the token ids as a json encoded string inside the market
+        return tuple(orjson.loads(market["clobTokenIds"]))
 
     @staticmethod
     def _get_timestamp() -> int:
-        timestamp = time.time_ns() // 10**9
-        return (timestamp // 900) * 900
+        return int(time.time()) // 900 * 900
 
 
 async def main():
@@ -181,21 +546,60 @@ async def main():
         nargs="?",
         type=Path,
     )
+    parser.add_argument(
+        "-u",
+        "--uring",
+        help="Write the logs through io_uring (Linux only, requires liburing).",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-s",
+        "--sync-every",
+        help="Sync the logs to disk after this many flushes (0 disables it).",
+        nargs="?",
+        type=int,
+        default=0,
+    )
 
     arguments = parser.parse_args()
 
+    if arguments.uring and liburing is None:
+        parser.error("--uring requires the liburing package")
+
     windows = arguments.windows
     directory = arguments.directory
-    daemons = [Daemon(coin, directory) for coin in arguments.coins]
+    uring = arguments.uring
+    sync_every = arguments.sync_every
+
+    # one session, and so one connection pool and dns cache, for every coin
+    session = aiohttp.ClientSession(
+        Daemon._PM_GAMMA_ENDPOINT,
+        connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300),
+    )
+
+    # every coin's markets are subscribed to over the same websocket
+    multiplexer = Multiplexer()
+
+    async with session:
+        daemons = [
+            Daemon(coin, session, multiplexer, directory, uring, sync_every)
+            for coin in arguments.coins
+        ]
 
-    info(f"set to monitor {[daemon.coin for daemon in daemons]}")
+        info(f"set to monitor {[daemon.coin for daemon in daemons]}")
 
-    async with asyncio.TaskGroup() as tg:
-        _tasks = [tg.create_task(daemon.capture(windows)) for daemon in daemons]
+        try:
+            async with asyncio.TaskGroup() as tg:
+                _tasks = [tg.create_task(daemon.capture(windows)) for daemon in daemons]
+        finally:
+            await multiplexer.close()
 
-    async with asyncio.TaskGroup() as tg:
-        _tasks = [tg.create_task(daemon.close()) for daemon in daemons]
+            async with asyncio.TaskGroup() as tg:
+                _tasks = [tg.create_task(daemon.close()) for daemon in daemons]
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())